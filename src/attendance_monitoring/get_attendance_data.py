@@ -2,53 +2,84 @@
 """
 This script retrieves attendance data from SEQTA and saves it to disk.
 
-The data is retrieved from the SEQTA endpoint in XML format and converted to
-JSON before being saved to disk. The JSON data is then loaded into a polars
-DataFrame and saved to disk in parquet format.
+The data is retrieved from the SEQTA endpoint in XML format and streamed
+through an incremental parser, one record at a time. The raw records are
+then loaded into a polars DataFrame, which casts them to the attendance
+schema, and saved to disk in parquet format.
 
-The script also saves the data to a DuckDB database file. However, this is
-likely to be removed in the future as a separate script will be used to
-combine multiple parquet files into a single DuckDB database file.
+The script can also save the data to a DuckDB database file (off by default,
+see --persist-duckdb). However, this is likely to be removed in the future as
+a separate script will be used to combine multiple parquet files into a single
+DuckDB database file.
 
 That DuckDB database will then be used to query the data and generate reports.
 """
 
 import os
+from functools import lru_cache
+from pathlib import Path
 import polars as pl
-import xmltodict
+from lxml import etree
 import json
 import requests
 import duckdb
-from typing import List, Optional
-from pydantic import BaseModel, TypeAdapter
-import datetime
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 import typer
 
-
-class AttendanceRecord(BaseModel):
-    student_code: str
-    absence_date: datetime.date
-    period_code: int  # This is a code
-    attendance_code: str
-    trigger_absentee_sms: bool
-    considered_late: bool
-    resolved: bool
-    on_campus: bool
-    authorised: bool
-    start_time: datetime.time
-    end_time: datetime.time
-    comments: Optional[str] = (
-        None  # Making this optional in case it's not always present
-    )
+ATTENDANCE_SCHEMA = {
+    "student_code": pl.Utf8,
+    "absence_date": pl.Date,
+    "period_code": pl.Int64,  # This is a code
+    "attendance_code": pl.Utf8,
+    "trigger_absentee_sms": pl.Boolean,
+    "considered_late": pl.Boolean,
+    "resolved": pl.Boolean,
+    "on_campus": pl.Boolean,
+    "authorised": pl.Boolean,
+    "start_time": pl.Time,
+    "end_time": pl.Time,
+    "comments": pl.Utf8,  # May be null, it's not always present
+}
+
+# The XML encodes booleans as text
+BOOLEAN_STRINGS = {"true": True, "false": False, "1": True, "0": False}
+# Formats tried in order, these cover the forms Pydantic used to accept
+DATE_FORMATS = ["%Y-%m-%d", "%Y-%m-%dT00:00:00"]
+TIME_FORMATS = ["%H:%M:%S", "%H:%M:%S%.f", "%H:%M"]
+
+
+def _cast_from_text(name: str, dtype: pl.DataType) -> pl.Expr:
+    # Casts are not strict, values that fail to parse become null and are
+    # reported by to_dataframe
+    col = pl.col(name)
+    if dtype == pl.Date:
+        return pl.coalesce(
+            col.str.to_date(fmt, strict=False) for fmt in DATE_FORMATS
+        ).alias(name)
+    if dtype == pl.Time:
+        return pl.coalesce(
+            col.str.to_time(fmt, strict=False) for fmt in TIME_FORMATS
+        ).alias(name)
+    if dtype == pl.Boolean:
+        return col.str.to_lowercase().replace_strict(
+            BOOLEAN_STRINGS, default=None, return_dtype=pl.Boolean
+        )
+    return col.cast(dtype, strict=False)
 
 
-class AttendanceResponse(BaseModel):
-    timestamp: str
-    data: List[AttendanceRecord]
+# Every field arrives as text, these are built once and reused for each request
+RAW_SCHEMA = {name: pl.Utf8 for name in ATTENDANCE_SCHEMA}
+ATTENDANCE_CASTS = [
+    _cast_from_text(name, dtype) for name, dtype in ATTENDANCE_SCHEMA.items()
+]
+# Only the comments are optional, every other field must be present
+REQUIRED_FIELDS = [name for name in ATTENDANCE_SCHEMA if name != "comments"]
 
 
+@lru_cache(maxsize=1)
 def get_seqta_password() -> str:
+    # Cached, so .env is only read once per process
     load_dotenv()
     if (password := os.getenv("SEQTA_PASSWORD")) is None:
         raise ValueError("The environment variable SEQTA_PASSWORD is not set.")
@@ -61,6 +92,7 @@ def main(
     username: str = "mgm",
     cache_json: bool = False,
     output_dir: str = "data/raw",
+    persist_duckdb: bool = False,
 ) -> None:
     url = f"{api_url}?date={start_date}"
 
@@ -71,46 +103,114 @@ def main(
     print("[SUCCESS]")
 
     print("Creating DataFrame", end="... ")
-    df = pl.DataFrame(attendance_data)
+    df = to_dataframe(attendance_data)
     print("[SUCCESS]")
     print("Writing to disk", end="... ")
-    write_table_to_disk(df, output_dir, "attendance_records", "attendance_records")
+    write_table_to_disk(
+        df, output_dir, "attendance_records", "attendance_records", persist_duckdb
+    )
     print("[SUCCESS]")
 
 
 def write_table_to_disk(
-    df: pl.DataFrame, output_dir: str, table_name: str, db_file_name: str
+    df: pl.DataFrame,
+    output_dir: str,
+    table_name: str,
+    db_file_name: str,
+    persist_duckdb: bool = False,
 ) -> None:
     # Save this
-    df.write_parquet(f"{output_dir}/{table_name}.parquet")
-    write_to_duckdb(df, f"{output_dir}/{db_file_name}.duckdb", table_name)
+    write_parquet(df, f"{output_dir}/{table_name}.parquet")
+    if persist_duckdb:
+        write_to_duckdb(df, f"{output_dir}/{db_file_name}.duckdb", table_name)
 
 
-def make_request(
-    url: str, username: str, password: str, cache_json: bool = False
-) -> List[AttendanceRecord]:
-    # Make the GET request with basic authentication
-    response = requests.get(url, auth=(username, password))
-    # Check the response
+def write_parquet(df: pl.DataFrame, path: str | Path) -> None:
+    """
+    Writes a DataFrame to parquet using the pyarrow writer with zstd
+    (level 3) compression, which is smaller than snappy and much faster
+    to write than gzip.
+    """
+    df.write_parquet(
+        path,
+        use_pyarrow=True,
+        compression="zstd",
+        compression_level=3,
+        statistics=True,
+        row_group_size=128 * 1024,
+    )
 
-    if response.status_code != 200:
-        print("Error: Could not retrieve data")
-        print(response.status_code)
 
-    # The content is xml, convert to json
-    dict_data = xmltodict.parse(response.content)
+def make_request(
+    url: str, username: str, password: str, cache_json: bool = False
+) -> Dict[str, List[Optional[str]]]:
+    # Make the GET request with basic authentication, streaming the body so
+    # parsing overlaps with the download. The context manager releases the
+    # connection even if parsing fails part way through.
+    with requests.get(url, auth=(username, password), stream=True) as response:
+        # Check the response
+        if response.status_code != 200:
+            print("Error: Could not retrieve data")
+            print(response.status_code)
+
+        # Undo any gzip/deflate transfer encoding so the parser sees plain XML
+        response.raw.decode_content = True
+
+        # The content is xml, parse each <data> record as it arrives and
+        # append its fields to one list per column, missing fields are None
+        columns: Dict[str, List[Optional[str]]] = {
+            name: [] for name in ATTENDANCE_SCHEMA
+        }
+        for _event, elem in etree.iterparse(response.raw, events=("end",), tag="data"):
+            fields = {child.tag: child.text for child in elem}
+            for name, values in columns.items():
+                values.append(fields.get(name))
+            # Free the record and any already processed siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
     if cache_json:
         print("Caching JSON data", end="... ")
         # Save to a file
         with open("attendance_data.json", "w") as file:
-            json.dump(dict_data, file)
+            json.dump(columns, file)
         print("[SUCCESS]")
 
-    ta_attendance_response = TypeAdapter(AttendanceResponse)
+    return columns
+
+
+def to_dataframe(columns: Dict[str, List[Optional[str]]]) -> pl.DataFrame:
+    """
+    Builds a DataFrame from the raw attendance columns returned by make_request.
+
+    Every field is loaded as text and then cast column by column to
+    ATTENDANCE_SCHEMA, so parsing happens in polars rather than per record
+    in Python. Values that cannot be parsed raise an error and so does a
+    missing value in any required field.
 
-    attendance_response = ta_attendance_response.validate_python(dict_data["response"])
-    return attendance_response.data
+    Dates are accepted as YYYY-MM-DD, optionally followed by T00:00:00, and
+    times as HH:MM, HH:MM:SS or HH:MM:SS with fractional seconds.
+    """
+    raw = pl.DataFrame(columns, schema=RAW_SCHEMA)
+    df = raw.with_columns(ATTENDANCE_CASTS)
+
+    # A cast that produced more nulls than there was missing text failed to parse
+    if unparsed := [
+        name
+        for name in ATTENDANCE_SCHEMA
+        if df[name].null_count() > raw[name].null_count()
+    ]:
+        raise ValueError(
+            f"Attendance records have values that could not be parsed: {', '.join(unparsed)}"
+        )
+
+    null_counts = df.select(pl.col(REQUIRED_FIELDS).null_count()).row(0, named=True)
+    if missing := [name for name, count in null_counts.items() if count]:
+        raise ValueError(
+            f"Attendance records are missing required fields: {', '.join(missing)}"
+        )
+    return df
 
 
 def write_to_duckdb(df: pl.DataFrame, db_file_path: str, table_name: str) -> None:
@@ -122,20 +222,14 @@ def write_to_duckdb(df: pl.DataFrame, db_file_path: str, table_name: str) -> Non
     con = duckdb.connect(database=db_file_path, read_only=False)
 
     try:
-        # Create a temporary in-memory table from pandas DataFrame
-        con.register("temp_table", df)
+        # Hand DuckDB the Arrow buffers, it scans the local variable directly
+        arrow_tbl = df.to_arrow()  # noqa: F841
 
         # CTAS (Create Table As) method to create and populate the table in the database
-        con.execute(f"DROP TABLE IF EXISTS {table_name}")
-        con.execute(f"CREATE TABLE {table_name} AS SELECT * FROM temp_table")
+        con.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM arrow_tbl")
 
         # Verify the table exists and has the correct data
-        print(
-            con.execute(f"SELECT * FROM {table_name} LIMIT 10")
-            .pl()
-            .to_pandas()
-            .to_markdown(index=False)
-        )
+        print(con.execute(f"SELECT * FROM {table_name} LIMIT 10").pl())
 
     finally:
         # Close connection to the database file
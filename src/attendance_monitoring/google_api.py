@@ -1,15 +1,23 @@
 import os
+from functools import lru_cache
 from pathlib import Path
 import tempfile
 from google.oauth2.service_account import Credentials
 import io
 from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-from googleapiclient.discovery import build
+from googleapiclient.discovery import Resource, build
+from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 import sys
+import threading
 import polars as pl
+import pyarrow.parquet as pq
 
+# Large chunks keep the number of HTTPS round trips per download low
+DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
 
+
+@lru_cache(maxsize=1)
 def get_credentials() -> Credentials:
     """
     Retrieves and returns Google Drive API credentials from a service account file.
@@ -31,6 +39,9 @@ def get_credentials() -> Credentials:
         FileNotFoundError: If the specified SERVICE_ACCOUNT_FILE does not exist.
         ValueError: If the content of the SERVICE_ACCOUNT_FILE is invalid or improperly formatted.
 
+    Notes:
+        - The result is cached, the key file is only read once per process.
+
     """
 
     # Setup the Drive API
@@ -49,6 +60,30 @@ def get_credentials() -> Credentials:
     return credentials
 
 
+# httplib2, which googleapiclient uses underneath, is not thread-safe,
+# so each thread gets its own Drive service
+_thread_local = threading.local()
+
+
+def _get_drive_service() -> Resource:
+    """
+    Builds the Google Drive v3 service once per thread and returns the same instance on later calls.
+
+    The service is built from the static discovery document bundled with
+    googleapiclient, so no discovery request or file cache lookup is made.
+    """
+    if (service := getattr(_thread_local, "drive_service", None)) is None:
+        service = build(
+            "drive",
+            "v3",
+            credentials=get_credentials(),
+            cache_discovery=False,
+            static_discovery=True,
+        )
+        _thread_local.drive_service = service
+    return service
+
+
 def get_files() -> dict[str, str]:
     """
     Retrieves a list of files from Google Drive and returns their IDs and names as a dictionary.
@@ -59,7 +94,7 @@ def get_files() -> dict[str, str]:
 
     Notes:
         - This function uses Google Drive API v3 to fetch details about files.
-        - The credentials required for authenticating with the Google Drive service are obtained from `get_credentials()`.
+        - The Google Drive service is shared across calls, see `_get_drive_service()`.
         - Only the first 10 files (pageSize=10) are fetched, including their IDs and names.
         - In case of an unexpected error while processing a file's ID or name, it is logged to stderr but does not halt the function execution.
 
@@ -70,8 +105,7 @@ def get_files() -> dict[str, str]:
     Raises:
         Any exception raised by the Google Drive API calls will be propagated.
     """
-    credentials = get_credentials()
-    service = build("drive", "v3", credentials=credentials)
+    service = _get_drive_service()
 
     # Call the Drive v3 API to list files
     results = (
@@ -115,30 +149,43 @@ def get_file_bytes(file_id: str) -> bytes:
 
     Notes:
         - This function uses the Google Drive v3 API to fetch the file.
-        - Credentials for authentication are obtained from `get_credentials()`.
+        - The Google Drive service is shared across calls, see `_get_drive_service()`.
         - A chunk downloader is used to handle large files, otherwise they may time out.
-        - The download progress % is printed to stdout
+        - The download progress % is printed to stdout when the DEBUG environment variable is set to something other than "" or "0"
 
     Example:
         >>> get_file_bytes('file_id_123')
         b'\\x00...<raw byte content>...'
     """
-    creds = get_credentials()
-    service = build("drive", "v3", credentials=creds)
+    return _get_file_buffer(file_id).getvalue()
+
+
+def _get_file_buffer(file_id: str) -> io.BytesIO:
+    """
+    Downloads a file from Google Drive into an in-memory buffer, see get_file_bytes.
+
+    The buffer is rewound to the start so it can be passed straight to a reader
+    without copying the content out with getvalue().
+    """
+    service = _get_drive_service()
 
     # Build a Chunk Downloader to handle large files
     request = service.files().get_media(fileId=file_id)
     file = io.BytesIO()
-    downloader = MediaIoBaseDownload(file, request)
+    downloader = MediaIoBaseDownload(file, request, chunksize=DOWNLOAD_CHUNK_SIZE)
 
     # Download and combine the chunks
+    show_progress = os.getenv("DEBUG", "") not in ("", "0")
     done = False
     while done is False:
         status, done = downloader.next_chunk()
-        print(f"\rDownload {int(status.progress() * 100)}.", end="")
-    print("")
+        if show_progress:
+            print(f"\rDownload {int(status.progress() * 100)}.", end="")
+    if show_progress:
+        print("")
 
-    return file.getvalue()
+    file.seek(0)
+    return file
 
 
 def get_file_name(file_id: str) -> str:
@@ -152,11 +199,12 @@ def get_file_name(file_id: str) -> str:
         str: The name of the file associated with the given ID.
 
     Raises:
-        FileNotFoundError: If the provided `file_id` does not exist or is not found in the files retrieved from Google Drive.
+        FileNotFoundError: If the provided `file_id` does not exist or has not been shared with the service account.
+        HttpError: For any other error returned by the Google Drive API.
 
     Notes:
-        - This function relies on the `get_files()` function to fetch a dictionary of file IDs and their names.
-        - If the `file_id` is not present in the dictionary returned by `get_files()`, a KeyError is caught, and a FileNotFoundError is raised with an appropriate message.
+        - This function fetches only the `name` metadata field of the single file, so it is not limited to the first page of `get_files()`.
+        - A 404 from the Google Drive API is raised as a FileNotFoundError with an appropriate message.
 
     Example:
         >>> get_file_name('1234567890')
@@ -167,14 +215,17 @@ def get_file_name(file_id: str) -> str:
             ...
         FileNotFoundError: ID: invalid_id not found on Google Drive, check it's been shared with the service account
     """
+    service = _get_drive_service()
     try:
-        file_name = get_files()[file_id]
-    except KeyError:
-        raise FileNotFoundError(
-            f"ID: {file_id} not found on Google Drive, check it's been shared with the service account"
-        )
+        file = service.files().get(fileId=file_id, fields="name").execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            raise FileNotFoundError(
+                f"ID: {file_id} not found on Google Drive, check it's been shared with the service account"
+            ) from e
+        raise
 
-    return file_name
+    return file["name"]
 
 
 def download_file(dir: Path, file_id: str) -> Path | None:
@@ -234,8 +285,8 @@ def read_excel(file_id: str) -> dict[str, pl.DataFrame]:
                                  and the corresponding value is a Polars DataFrame containing the data from that sheet.
 
     Notes:
-        - This function first retrieves the bytes of the specified Excel file using `get_file_bytes`.
-        - The temporary file is created in the system's default temporary directory.
+        - This function first downloads the specified Excel file into memory and writes it to a temporary file.
+        - The temporary file is created in the system's default temporary directory and removed after reading.
         - After reading the file, it uses Polars (`pl.read_excel`) to parse the Excel sheets into DataFrames.
         - The `infer_schema_length=None` argument ensures that the schema is inferred from all rows rather than a sample. Important for Excel which is loosely typed.
 
@@ -248,33 +299,31 @@ def read_excel(file_id: str) -> dict[str, pl.DataFrame]:
         {'Sheet1': shape: (10, 5),
          'Sheet2': shape: (20, 3)}
     """
-    file = tempfile.mktemp()
-    if fb := get_file_bytes(file_id):
-        with open(file, "wb") as fp:
-            fp.write(fb)
-    return pl.read_excel(file, infer_schema_length=None, sheet_id=0)
+    buffer = _get_file_buffer(file_id)
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as fp:
+        fp.write(buffer.getbuffer())
+    try:
+        return pl.read_excel(fp.name, infer_schema_length=None, sheet_id=0)
+    finally:
+        os.remove(fp.name)
 
 
 def read_csv(file_id: str) -> pl.DataFrame:
     """
     Reads a CSV, refer to the read_excel docstring.
+    The file is parsed straight from memory, it is not written to disk.
     """
-    file = tempfile.mktemp()
-    if fb := get_file_bytes(file_id):
-        with open(file, "wb") as fp:
-            fp.write(fb)
-    return pl.read_csv(file, infer_schema_length=None)
+    return pl.read_csv(_get_file_buffer(file_id), infer_schema_length=None)
 
 
-def read_parquet(file_id: str) -> pl.DataFrame:
+def read_parquet(file_id: str, columns: list[str] | None = None) -> pl.DataFrame:
     """
     Reads a Parquet File, refer to the read_excel docstring.
+    The file is parsed straight from memory, it is not written to disk.
+    If columns are given only those are decoded, the rest of the file is skipped.
     """
-    file = tempfile.mktemp()
-    if fb := get_file_bytes(file_id):
-        with open(file, "wb") as fp:
-            fp.write(fb)
-    return pl.read_parquet(file)
+    table = pq.read_table(_get_file_buffer(file_id), columns=columns)
+    return pl.from_arrow(table)
 
 
 def upload_file(file_path: str | Path, file_id: str) -> None:
@@ -301,8 +350,7 @@ def upload_file(file_path: str | Path, file_id: str) -> None:
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Local file {file_path} not found")
 
-    creds = get_credentials()
-    service = build("drive", "v3", credentials=creds)
+    service = _get_drive_service()
 
     # Create media upload object
     media = MediaFileUpload(file_path, resumable=True)
@@ -341,8 +389,7 @@ def create_file(file_path: str | Path, name: str | None = None) -> str:
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Local file {file_path} not found")
 
-    creds = get_credentials()
-    service = build("drive", "v3", credentials=creds)
+    service = _get_drive_service()
 
     # Use provided name or get filename from path
     file_metadata = {"name": name if name else Path(file_path).name}
@@ -389,8 +436,7 @@ def create_file_under_shared_directory(
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Local file {file_path} not found")
 
-    creds = get_credentials()
-    service = build("drive", "v3", credentials=creds)
+    service = _get_drive_service()
 
     # Use provided name or get filename from path
     file_metadata = {
@@ -443,8 +489,7 @@ def share_file(file_id: str, email: str, role: str = "writer") -> None:
     if role not in valid_roles:
         raise ValueError(f"Role must be one of: {', '.join(valid_roles)}")
 
-    creds = get_credentials()
-    service = build("drive", "v3", credentials=creds)
+    service = _get_drive_service()
 
     # Create the permission
     permission = {"type": "user", "role": role, "emailAddress": email}
@@ -455,7 +500,9 @@ def share_file(file_id: str, email: str, role: str = "writer") -> None:
     ).execute()
 
 
-def pull_table(database: str, table_name) -> pl.DataFrame:
+def pull_table(
+    database: str, table_name, columns: list[str] | None = None
+) -> pl.DataFrame:
     tables = {
         "postgres": {
             "subject": "1fJ7l2qUQpkmTV9AqVe7JSEqqcFhBnVmz",
@@ -469,4 +516,4 @@ def pull_table(database: str, table_name) -> pl.DataFrame:
         "sqlserver": {},
     }
 
-    return read_parquet(tables[database][table_name])
+    return read_parquet(tables[database][table_name], columns=columns)
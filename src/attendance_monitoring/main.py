@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
@@ -6,11 +7,14 @@ from datetime import date
 import os
 import polars as pl
 import datetime
-from .get_attendance_data import make_request, get_seqta_password
+from .get_attendance_data import (
+    make_request,
+    get_seqta_password,
+    to_dataframe,
+    write_parquet,
+)
 from .google_api import pull_table
 
-pl.Config(tbl_cols=int(80 / 5), tbl_rows=6)
-
 
 def _get_cache_directory(start_date: date) -> Path:
     xdg_cache_home = os.environ.get(
@@ -18,7 +22,7 @@ def _get_cache_directory(start_date: date) -> Path:
     )
     cache_dir = os.path.join(xdg_cache_home, "sirius_college", "attendance_data")
     os.makedirs(Path(cache_dir), exist_ok=True)
-    cache_file = os.path.join(cache_dir, f"attendance_data-{start_date}")
+    cache_file = os.path.join(cache_dir, f"attendance_data-{start_date}.parquet")
     return Path(cache_file)
 
 
@@ -30,23 +34,28 @@ class API_Credentials:
         self.username = "mgm"
 
 
-def get_attendance_data(start_date: date) -> pl.DataFrame:
+def get_attendance_data(start_date: date) -> pl.LazyFrame:
     cache_data = True
     cache_file = _get_cache_directory(start_date)
-    try:
-        df = pl.read_parquet(cache_file)
-    except FileNotFoundError:
-        creds = API_Credentials(start_date)
-        attendance_data = make_request(creds.url, creds.username, creds.password, False)
-        # This takes 30 seconds, however, caching it presents security challenges
-        df = pl.DataFrame(attendance_data)
-        if cache_data:
-            df.write_parquet(cache_file)
+    if cache_file.exists():
+        return pl.scan_parquet(cache_file)
 
-    return df
+    creds = API_Credentials(start_date)
+    attendance_data = make_request(creds.url, creds.username, creds.password, False)
+    # This takes 30 seconds, however, caching it presents security challenges
+    df = to_dataframe(attendance_data)
+    if cache_data:
+        # Write then rename so an interrupted run never leaves a partial cache
+        tmp_file = cache_file.with_suffix(".parquet.tmp")
+        write_parquet(df, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    return df.lazy()
 
 
 def main():
+    pl.Config.set_tbl_cols(16)
+    pl.Config.set_tbl_rows(6)
     # df = join_data(DataStore.DRIVE_API)
     df = join_data(DataStore.LOCAL).sort(["absence_date", "period_code"])
     # (
@@ -84,16 +93,40 @@ class DataBase:
         )
         self.store = store
 
-    def get_table(self, source: DataSource, table: str) -> pl.DataFrame:
+    def get_table(
+        self, source: DataSource, table: str, columns: list[str] | None = None
+    ) -> pl.DataFrame:
+        """
+        Reads a table, only decoding the given columns if any are provided.
+        """
         match self.store:
             case DataStore.LOCAL:
                 path = os.path.join(self.dir, source.value, f"{table}.parquet")
-                return pl.read_parquet(path)
+                return pl.read_parquet(path, columns=columns)
             case DataStore.DRIVE_API:
-                return pull_table(database=DataSource.POSTGRES.value, table_name=table)
+                return pull_table(
+                    database=DataSource.POSTGRES.value,
+                    table_name=table,
+                    columns=columns,
+                )
             case _:
                 raise NotImplementedError
 
+    def get_table_lazy(
+        self, source: DataSource, table: str, columns: list[str] | None = None
+    ) -> pl.LazyFrame:
+        """
+        Like get_table but returns a LazyFrame. Local parquet files are scanned
+        rather than read, so polars reads them as part of the query that uses them.
+        """
+        match self.store:
+            case DataStore.LOCAL:
+                path = os.path.join(self.dir, source.value, f"{table}.parquet")
+                lf = pl.scan_parquet(path)
+                return lf if columns is None else lf.select(columns)
+            case _:
+                return self.get_table(source, table, columns).lazy()
+
 
 def join_data(store: DataStore):
     database = DataBase(store)
@@ -101,46 +134,53 @@ def join_data(store: DataStore):
     today = date.today()
     start_date = today - datetime.timedelta(days=7 * 18)
 
-    df = get_attendance_data(start_date)
-    df = df.filter(
-        pl.col("attendance_code").str.contains("absenceapproved").not_()
-    ).filter(pl.col("resolved").not_())
-    print(df[:6, :].to_pandas().to_markdown())
+    # A single predicate so both conditions are evaluated in one pass
+    df = get_attendance_data(start_date).filter(
+        pl.col("resolved").not_()
+        & pl.col("attendance_code").str.contains("absenceapproved", literal=True).not_()
+    )
 
     # TODO pull from Google Drive API
-    ci = database.get_table(DataSource.POSTGRES, "classinstance")
-    p = database.get_table(DataSource.POSTGRES, "period")
-    student = database.get_table(DataSource.POSTGRES, "vw_student_details")
-    student = student.select(
-        "Student Code",
-        "Student First Name",
-        "Student Surname",
-        "Student Preferred Name",
-        "Student DOB",
-        "Student Gender",
-        "Roll Group",
-        "Campus Code",
-        "Student Email",
-    )
-    class_times = (
-        ci.rename(
-            {
-                "period": "period_id",
-                "date": "class_date",
-                "start": "class_start_time",
-                "end": "class_end_time",
-            }
-        )
-        .select(
-            ["period_id", "code", "class_date", "class_start_time", "class_end_time"]
-        )
-        .join(
-            p.rename({"code": "period"}).select(["id", "period"]),
-            left_on="period_id",
-            right_on="id",
-        )
-        # NOTE strict fills with Null
-        .with_columns(period=pl.col("period").cast(pl.Int64, strict=False))
+    # Only the columns used below are read from each table
+    tables = {
+        "classinstance": ["period", "code", "date", "start", "end"],
+        "period": ["id", "code"],
+        "vw_student_details": [
+            "Student Code",
+            "Student First Name",
+            "Student Surname",
+            "Student Preferred Name",
+            "Student DOB",
+            "Student Gender",
+            "Roll Group",
+            "Campus Code",
+            "Student Email",
+        ],
+    }
+    # Local tables are only scanned here, but tables from the Drive API are
+    # independent downloads, so fetch them concurrently
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        futures = {
+            table: executor.submit(
+                database.get_table_lazy, DataSource.POSTGRES, table, columns
+            )
+            for table, columns in tables.items()
+        }
+        ci, p, student = (futures[table].result() for table in tables)
+    class_times = ci.select(
+        pl.col("period").alias("period_id"),
+        pl.col("code"),
+        pl.col("date").alias("class_date"),
+        pl.col("start").alias("class_start_time"),
+        pl.col("end").alias("class_end_time"),
+    ).join(
+        p.select(
+            pl.col("id"),
+            # NOTE strict fills with Null
+            pl.col("code").cast(pl.Int64, strict=False).alias("period"),
+        ),
+        left_on="period_id",
+        right_on="id",
     )
 
     absence = df.join(
@@ -163,7 +203,13 @@ def join_data(store: DataStore):
         ]
     )
 
-    return absence.join(student, left_on="student_code", right_on="Student Code")
+    # The whole query, including the parquet scans, runs in a single collect
+    df = absence.join(
+        student, left_on="student_code", right_on="Student Code"
+    ).collect()
+    print(df.head(6))
+
+    return df
 
 
 if __name__ == "__main__":